@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from __future__ import print_function
 import argparse
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
 
 import logging
 from logging.config import dictConfig
 
+from io import BytesIO
 import os
 import sys
 
@@ -34,6 +38,9 @@ LANGUAGES = OrderedDict(
     pl="polnisch"
     )
 
+#: Map full language names to their shortcuts (inverse of LANGUAGES)
+SHORTCUTS = {name: short for short, name in LANGUAGES.items()}
+
 #: The dictionary, used by :class:`logging.config.dictConfig`
 #: use it to setup your logging formatters, handlers, and loggers
 #: For details, see
@@ -70,19 +77,112 @@ LOGLEVELS = {None: logging.WARNING,  # 0
 #: Instantiate our logger
 log = logging.getLogger(__name__)
 
-try:
-    import requests
-except ImportError:
-    log.fatal("ERROR: No requests module found. Install it with:\n"
-              "$ sudo zypper in python3-requests")
-    sys.exit(200)
+#: Maximum number of parallel connections (and lookups) to leo.org
+MAX_CONNECTIONS = 4
+
+#: Connect and read timeout (in seconds) for requests to leo.org
+TIMEOUT = (3.05, 10)
+
+#: Directory for the cached responses of leo.org
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME")
+                         or os.path.expanduser("~/.cache"),
+                         "leo")
+
+#: Time (in seconds) until a cached response expires
+CACHE_EXPIRE = 24 * 3600
+
+#: Select the translation rows of a section for a given language ($lang)
+ROWS_XPATH = "table/tbody/tr[td[@lang=$lang] and td[@lang='de']]"
+
+#: Return the text content of an element without non-breaking spaces and
+#: newlines and with normalized whitespace
+TEXT_XPATH = "normalize-space(translate(., '\u00a0\n', ''))"
+
+#: Parser options for Leo's HTML pages; comments and processing
+#: instructions are never needed and elements are not looked up by ID
+PARSER_OPTIONS = dict(html=True,
+                      remove_comments=True,
+                      remove_pis=True,
+                      collect_ids=False,
+                      )
+
+
+def import_requests():
+    """Import requests when it is needed for the first time
+
+    requests and lxml are only imported when a query is looked up,
+    so ``--help`` and usage errors don't have to wait for them.
+
+    :return: the requests module
+    """
+    try:
+        import requests
+    except ImportError:
+        log.fatal("ERROR: No requests module found. Install it with:\n"
+                  "$ sudo zypper in python3-requests")
+        sys.exit(200)
+    return requests
+
+
+def import_etree():
+    """Import lxml when it is needed for the first time
+
+    :return: the lxml.etree module
+    """
+    try:
+        from lxml import etree
+    except ImportError:
+        log.fatal("ERROR: no lxml module found. Install it with:\n"
+                  "$ sudo zypper in python3-lxml")
+        sys.exit(10)
+    return etree
+
+
+@lru_cache(maxsize=None)
+def compile_xpath(path, smart_strings=True):
+    """Compile an XPath expression once and reuse it afterwards
+
+    :param str path: the XPath expression
+    :param bool smart_strings: return smart strings for text results
+    :return: the compiled XPath
+    :rtype: :class:`lxml.etree.XPath`
+    """
+    return import_etree().XPath(path, smart_strings=smart_strings)
+
 
-try:
-    from lxml import html as htmlparser
-except ImportError:
-    log.fatal("ERROR: no lxml module found. Install it with:\n"
-              "$ sudo zypper in python3-lxml")
-    sys.exit(10)
+@lru_cache(maxsize=None)
+def get_session():
+    """Return the shared HTTP session
+
+    The session keeps the connection to leo.org alive between requests
+    instead of opening a new one for every query and serves repeated
+    queries from an on-disk cache.
+
+    :return: the session
+    :rtype: :class:`requests_cache.CachedSession`
+    """
+    requests = import_requests()
+    try:
+        import requests_cache
+    except ImportError:
+        log.fatal("ERROR: No requests_cache module found. Install it with:\n"
+                  "$ sudo zypper in python3-requests-cache")
+        sys.exit(201)
+
+    session = requests_cache.CachedSession(os.path.join(CACHE_DIR, "http"),
+                                           backend="sqlite",
+                                           expire_after=CACHE_EXPIRE,
+                                           allowable_codes=(200,),
+                                           )
+    # leo.org is queried over plain http, where HTTP/2 can't be
+    # negotiated, so parallel lookups share a HTTP/1.1 keep-alive pool:
+    for prefix in ("http://", "https://"):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=MAX_CONNECTIONS)
+        session.mount(prefix, adapter)
+    session.headers.update({"User-Agent": "leo/{0}".format(__version__)})
+    atexit.register(session.close)
+    return session
 
 
 def available_languages():
@@ -97,6 +197,7 @@ def available_languages():
     return ", ".join(language_strings)
 
 
+@lru_cache(maxsize=None)
 def lang_name(lang=None):
     """Translate language shortcut to the full language name.
 
@@ -110,12 +211,13 @@ def lang_name(lang=None):
     try:
         return LANGUAGES[lang]
     except KeyError:
-        if lang in LANGUAGES.values():
+        if lang in SHORTCUTS:
             return lang
         else:
-            return list(LANGUAGES.values())[0]
+            return next(iter(LANGUAGES.values()))
 
 
+@lru_cache(maxsize=None)
 def lang_short(lang=None):
     """Translate language name to the shortcut.
 
@@ -129,11 +231,7 @@ def lang_short(lang=None):
     if lang in LANGUAGES:
         return lang
     else:
-        for short, name in LANGUAGES.items():
-            if name == lang:
-                return short
-
-        return list(LANGUAGES.keys())[0]
+        return SHORTCUTS.get(lang, next(iter(LANGUAGES)))
 
 
 def default_lang():
@@ -163,7 +261,7 @@ def parse(cliargs=None):
     :rtype: :class:`argparse.Namespace`
     """
     parser = argparse.ArgumentParser(description='Query leo.org',
-                                     usage='%(prog)s [OPTIONS] QUERYSTRING')
+                                     usage='%(prog)s [OPTIONS] QUERYSTRING...')
     parser.add_argument('-D', '--with-defs',
                         action="store_true",
                         default=False,
@@ -203,42 +301,99 @@ def parse(cliargs=None):
     #   )
     parser.add_argument('query',
                         metavar="QUERYSTRING",
-                        help="Query string",
+                        nargs="+",
+                        help="Query string(s); several queries are "
+                             "looked up in parallel",
                         )
     args = parser.parse_args(cliargs)
 
-    # Setup logging and the log level according to the "-v" option
-    dictConfig(DEFAULT_LOGGING_DICT)
-    log.setLevel(LOGLEVELS.get(args.verbose, logging.DEBUG))
+    # Setup logging and the log level according to the "-v" option.
+    # Without it, only warnings and errors are shown and Python's
+    # last resort handler is good enough for them:
+    if args.verbose:
+        dictConfig(DEFAULT_LOGGING_DICT)
+        log.setLevel(LOGLEVELS.get(args.verbose, logging.DEBUG))
     log.debug("CLI args: %s", args)
     return args
 
 
 def get_leo_page(url):
-    """Return root node of Leo's result HTML page
+    """Return Leo's result HTML page
+
+    The page is read completely, as a response from leo.org has to be
+    stored in the cache before it can be parsed.
 
     :param str url: the URL to be loaded
-    :return: the HTML page as text
-    :rtype: :class:`str`
+    :return: the (decompressed) HTML page as a file-like byte stream
+             and the charset from the Content-Type header (or None)
+    :rtype: tuple(:class:`io.BytesIO`, str)
     """
     log.debug("Trying to load %r...", url)
-    response = requests.get(url)
+    response = get_session().get(url, timeout=TIMEOUT)
     if not response.ok:
-        raise requests.exceptions.HTTPError(response)
-    return response.text
+        raise import_requests().exceptions.HTTPError(response)
+    # requests falls back to ISO-8859-1 for text/* without a charset;
+    # only trust the encoding if the server named it:
+    if "charset" in response.headers.get("Content-Type", "").lower():
+        encoding = response.encoding
+    else:
+        encoding = None
+    return BytesIO(response.content), encoding
+
 
+def section_xpath(names):
+    """Compile an XPath which tests for a wanted result section
 
-def parse_leo_page(text):
-    """Return root node of Leo's result HTML page
+    The XPath is true for an element of class ``section`` inside the
+    ``centerColumn`` element whose ``data-dz-name`` attribute is one
+    of names. The names are passed as the variables ``$n0``, ``$n1``...
 
-    :param str text: the HTML page as text
-    :return: the HTML tree
-    :rtype: :class:`lxml.html.HtmlElement`
+    :param names: the section names to look for
+    :return: the compiled XPath
+    :rtype: :class:`lxml.etree.XPath`
     """
-    document = htmlparser.fromstring(text)
-    html = document.getroottree()
-    log.debug("Got HTML page")
-    return html
+    predicate = " or ".join("@data-dz-name=$n{0}".format(i)
+                            for i in range(len(names)))
+    return compile_xpath("boolean(self::*"
+                         "[contains(concat(' ', normalize-space(@class), ' '),"
+                         " ' section ')]"
+                         "[ancestor::*[@id='centerColumn']]"
+                         "[{0}])".format(predicate or "false()"))
+
+
+def iter_sections(source, names, limit=5, encoding=None):
+    """Yield the result sections of Leo's page while it is parsed
+
+    Only sections inside the ``centerColumn`` element whose
+    ``data-dz-name`` attribute is one of names are yielded.
+    Every section is cleared after it has been processed and parsing
+    stops as soon as limit sections were found.
+
+    :param source: the HTML page as a file-like byte stream
+    :param names: the section names to look for
+    :param int limit: the maximum number of sections
+    :param str encoding: the encoding of the page (default: UTF-8)
+    :return: generator of section element nodes
+    """
+    names = tuple(names)
+    is_section = section_xpath(names)
+    variables = {"n{0}".format(i): name for i, name in enumerate(names)}
+    count = 0
+    etree = import_etree()
+    for _, element in etree.iterparse(source, events=("end",), tag="div",
+                                      encoding=encoding or "utf-8",
+                                      **PARSER_OPTIONS):
+        if not is_section(element, **variables):
+            continue
+        count += 1
+        yield element
+        # Drop everything we have already seen:
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if count == limit:
+            break
+    log.debug("Got %i section(s)", count)
 
 
 def extract_text(element):
@@ -248,50 +403,42 @@ def extract_text(element):
     :return: fixed text content
     :rtype: str
     """
-    # Fix some encoding problems:
-    txt = element.text_content().replace('\xa0', '')\
-                                .replace('\xdf', 'ß')\
-                                .replace('\n', '')
-    return txt
+    return compile_xpath(TEXT_XPATH, smart_strings=False)(element)
 
 
-def format_as_table(row):
+def format_as_table(row, header=""):
     """Format the row as a table and print it out
 
+    The header and the table are written with a single call.
+
     :param row: node of a row which contains <tr> elements
+    :param str header: text to print before the table
     """
     log.debug("Row: %s", row)
-    widths = []
+    max_width = 0
     translations = []
 
     for tr in row:
         entry = tr.getchildren()
         entry = entry[4], entry[7]
-        c1, c2 = [extract_text(en) for en in entry if len(extract_text(en))]
-        t1 = c1.strip()
-        t1 = " ".join(t1.split())
+        t1, t2 = [text for text in map(extract_text, entry) if text]
         t1 = t1.replace("AE", " [AE]")  # TODO: fix this workaround
         t1 = t1.replace("BE", " [BE]")  # TODO: fix this workaround
-        t2 = c2.strip()
-        t2 = " ".join(t2.split())
-        widths.append(len(t1))
+        if len(t1) > max_width:
+            max_width = len(t1)
         translations.append((t1, t2))
 
-    max_width = max(widths)
+    sys.stdout.write(header + "".join(t1.ljust(max_width) + " | " + t2 + "\n"
+                                      for t1, t2 in translations))
 
-    for t1, t2 in translations:
-        print("{left:<{width}} | {right}".format(
-            left=t1,
-            width=max_width,
-            right=t2)
-            )
 
-
-def get_results(args, root):
+def get_results(args, source, encoding=None):
     """Print the results
 
     :param args: parsed command line arguments
-    :param root: root element node
+    :param source: the HTML page as a file-like byte stream;
+                   it is closed afterwards
+    :param str encoding: the encoding of the page (default: UTF-8)
     """
     log.debug("Analysing results...")
     line = "-" * 10
@@ -311,40 +458,58 @@ def get_results(args, root):
 
     language_shortcut = lang_short(args.language)
 
-    found = set()
-    html = root.getroot()
-    div = html.get_element_by_id('centerColumn')
-    div = html.get_element_by_id('centerColumn')
-    for section in div.find_class("section")[:5]:
-        name = section.attrib.get('data-dz-name')
-        if name in data:
-            found.add(name)
-            print("\n{0} {1} {0}".format(line, data[name]))
-            trs = section.xpath("table/tbody/tr[td[@lang='{0}'] and "
-                                "td[@lang='de']]".format(language_shortcut))
-            format_as_table(trs)
+    rows = compile_xpath(ROWS_XPATH)
+    # Close the page even if parsing stops early or fails:
+    with closing(source):
+        for section in iter_sections(source, data, encoding=encoding):
+            name = section.attrib.get('data-dz-name')
+            trs = rows(section, lang=language_shortcut)
+            format_as_table(trs, "\n{0} {1} {0}\n".format(line,
+                                                          data[name]))
 
 
-if __name__ == "__main__":
-    args = parse()
+def main(cliargs=None):
+    """Look up all queries and print their results
+
+    All queries are looked up in parallel, but the results are printed
+    in the order of the command line. A failing query doesn't stop the
+    other ones; the return code is set by the last failure.
+
+    :param list cliargs: Arguments to parse or None (=use sys.argv)
+    :return: return code (0 on success)
+    :rtype: int
+    """
+    args = parse(cliargs)
     language = lang_name(args.language)
-    url = url.format(language, args.query)
+    requests = import_requests()
+    # Create the session before it is shared between the threads:
+    get_session()
 
     returncode = 0
-    try:
-        doc = parse_leo_page(get_leo_page(url))
-        get_results(args, doc)
-    except requests.exceptions.Timeout:
-        log.error("Timeout")
-        returncode = 10
-    except requests.exceptions.BaseHTTPError as err:
-        log.error("Basic HTTP error: %s", err)
-        returncode = 15
-    except IOError:
-        # Term wasn't found
-        log.error("No translation for %s was found", args.query)
-        returncode = 20
-
-    sys.exit(returncode)
+    with ThreadPoolExecutor(max_workers=MAX_CONNECTIONS) as executor:
+        # Start all lookups at once, but print the results in order:
+        pages = [executor.submit(get_leo_page, url.format(language, query))
+                 for query in args.query]
+        for query, page in zip(args.query, pages):
+            if len(args.query) > 1:
+                print("\n{0} {1} {0}".format("=" * 10, query))
+            try:
+                get_results(args, *page.result())
+            except requests.exceptions.Timeout:
+                log.error("Timeout")
+                returncode = 10
+            except requests.exceptions.BaseHTTPError as err:
+                log.error("Basic HTTP error: %s", err)
+                returncode = 15
+            except IOError:
+                # Term wasn't found
+                log.error("No translation for %s was found", query)
+                returncode = 20
+
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 # EOF
@@ -3,8 +3,9 @@ import leo
 
 
 @pytest.mark.parametrize('cli,expected', [
-    ([''], {'query': ''}),
-    (['Baum'], {'query': 'Baum'}),
+    ([''], {'query': ['']}),
+    (['Baum'], {'query': ['Baum']}),
+    (['Baum', 'Haus'], {'query': ['Baum', 'Haus']}),
     (['-D', 'Baum'], {'with_defs': True}),
     (['-E', 'baum'], {'with_examples': True}),
     (['--with-examples', 'baum'], {'with_examples': True}),
@@ -20,3 +21,14 @@ def test_parse_cli(cli, expected):
     diff = set(result.__dict__) & set(expected)
     result = {i: getattr(result, i) for i in diff}
     assert result == expected
+
+
+@pytest.mark.parametrize('lang,name,short', [
+    ('es', 'spanisch', 'es'),
+    ('spanisch', 'spanisch', 'es'),
+    ('xx', 'englisch', 'en'),
+    (None, 'englisch', 'en'),
+])
+def test_lang_name_and_short(lang, name, short):
+    assert leo.lang_name(lang) == name
+    assert leo.lang_short(lang) == short
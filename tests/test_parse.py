@@ -2,34 +2,90 @@ import leo
 import requests
 import pytest
 from unittest.mock import MagicMock
+from requests.adapters import HTTPAdapter
 from functools import partial
+from gzip import compress
+from io import BytesIO
 from os import path
 from lxml import html
+from urllib3 import HTTPResponse
 
 
-def mock_response_text(url, ok=True):
+def mock_content():
     current_dir = path.dirname(__file__)
-    with open(path.join(current_dir, "data/leo_mock_response.html"), "r") as htmlfile:
-        text = htmlfile.read()
+    filename = path.join(current_dir, "data/leo_mock_response.html")
+    with open(filename, "rb") as htmlfile:
+        return htmlfile.read()
+
+
+def mock_response_text(url, ok=True, **kwargs):
+    content = mock_content()
     response = MagicMock(spec=requests.Response)
     response.ok = ok
     response.url = url
-    response.text = text
+    response.content = content
+    response.headers = {"Content-Type": "text/html"}
     return response
 
 
-def test_get_leo_page_ok(monkeypatch):
-    monkeypatch.setattr(leo.requests, "get", partial(mock_response_text, ok=True))
-    assert leo.get_leo_page("mock") == mock_response_text("mock").text
+class MockAdapter(HTTPAdapter):
+    """Transport which serves the mock page and records the requests"""
+
+    def __init__(self, status=200, encoding=None, not_found=(),
+                 body=None, content_type="text/html"):
+        super().__init__()
+        self.status = status
+        self.encoding = encoding
+        self.not_found = not_found
+        self.body = body
+        self.content_type = content_type
+        self.calls = 0
+        self.request_headers = []
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        self.request_headers.append(request.headers)
+        status = self.status
+        if request.url.rsplit("/", 1)[-1] in self.not_found:
+            status = 404
+        body = mock_content() if self.body is None else self.body
+        headers = {"Content-Type": self.content_type}
+        if self.encoding == "gzip":
+            body = compress(body)
+            headers["Content-Encoding"] = "gzip"
+        raw = HTTPResponse(body=BytesIO(body),
+                           status=status,
+                           headers=headers,
+                           preload_content=False,
+                           request_url=request.url)
+        return self.build_response(request, raw)
+
+
+@pytest.fixture(autouse=True)
+def session(monkeypatch, tmp_path):
+    """Use a fresh session with its cache in a temporary directory"""
+    monkeypatch.setattr(leo, "CACHE_DIR", str(tmp_path))
+    leo.get_session.cache_clear()
+    yield leo.get_session()
+    leo.get_session().close()
+    leo.get_session.cache_clear()
 
 
-def test_get_leo_page_not_ok(monkeypatch):
-    monkeypatch.setattr(leo.requests, "get", partial(mock_response_text, ok=False))
+def test_get_leo_page_ok(session, monkeypatch):
+    monkeypatch.setattr(session, "get", partial(mock_response_text, ok=True))
+    expected = mock_response_text("mock").content
+    page, encoding = leo.get_leo_page("mock")
+    assert page.read() == expected
+    assert encoding is None
+
+
+def test_get_leo_page_not_ok(session, monkeypatch):
+    monkeypatch.setattr(session, "get", partial(mock_response_text, ok=False))
     with pytest.raises(requests.exceptions.HTTPError):
         leo.get_leo_page("mock")
 
 
-def test_parse_leo_page(monkeypatch):
+def test_iter_sections(session, monkeypatch):
     expected = [
         "subst_en_foo",
         "subst_de_foo",
@@ -52,13 +108,107 @@ def test_parse_leo_page(monkeypatch):
         "example_en_bar",
         "example_de_bar",
     ]
-    monkeypatch.setattr(leo.requests, "get", partial(mock_response_text, ok=True))
-    text_nodes = list(leo.parse_leo_page(leo.get_leo_page("mock")).getroot().itertext())
+    names = ["subst", "verb", "definition", "phrase", "example"]
+    monkeypatch.setattr(session, "get", partial(mock_response_text, ok=True))
+    text_nodes = []
+    page, _ = leo.get_leo_page("mock")
+    for section in leo.iter_sections(page, names):
+        text_nodes.extend(section.itertext())
     text_nodes = [node.strip() for node in text_nodes]
     text_nodes = list(filter(None, text_nodes))
     assert text_nodes == expected
 
 
+@pytest.mark.parametrize('names,limit,expected', [
+    (["subst", "verb", "adjadv"], 5, ["subst", "verb"]),
+    (["verb", "example"], 5, ["verb", "example"]),
+    (["subst", "verb", "definition", "phrase", "example"], 2,
+     ["subst", "verb"]),
+])
+def test_iter_sections_filter(session, monkeypatch, names, limit, expected):
+    monkeypatch.setattr(session, "get", partial(mock_response_text, ok=True))
+    page, _ = leo.get_leo_page("mock")
+    sections = leo.iter_sections(page, names, limit)
+    assert [section.get("data-dz-name") for section in sections] == expected
+
+
+def test_get_leo_page_gzip(session):
+    adapter = MockAdapter(encoding="gzip")
+    session.mount("http://", adapter)
+    page, _ = leo.get_leo_page("http://mock/englisch-deutsch/foo")
+    accept_encoding = adapter.request_headers[0]["Accept-Encoding"]
+    assert "gzip" in accept_encoding.split(", ")
+    sections = leo.iter_sections(page, ["verb"])
+    assert [section.get("data-dz-name") for section in sections] == ["verb"]
+
+
+def test_get_leo_page_cached(session):
+    adapter = MockAdapter()
+    session.mount("http://", adapter)
+    for _ in range(2):
+        leo.get_leo_page("http://mock/englisch-deutsch/foo")
+    assert adapter.calls == 1
+
+
+def test_get_leo_page_not_found_not_cached(session):
+    adapter = MockAdapter(404)
+    session.mount("http://", adapter)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            leo.get_leo_page("http://mock/englisch-deutsch/foo")
+    assert adapter.calls == 2
+
+
+def test_get_leo_page_cache_expired(monkeypatch):
+    monkeypatch.setattr(leo, "CACHE_EXPIRE", 0)
+    leo.get_session.cache_clear()
+    session = leo.get_session()
+    adapter = MockAdapter()
+    session.mount("http://", adapter)
+    for _ in range(2):
+        leo.get_leo_page("http://mock/englisch-deutsch/foo")
+    assert adapter.calls == 2
+
+
+UMLAUT_PAGE = """<html><body><div id="centerColumn">
+<div class="section" data-dz-name="subst">Stra\xdfe \xe4</div>
+</div></body></html>"""
+
+
+def test_iter_sections_utf8_without_meta_charset():
+    page = BytesIO(UMLAUT_PAGE.encode("utf-8"))
+    texts = [leo.extract_text(section)
+             for section in leo.iter_sections(page, ["subst"])]
+    assert texts == ["Stra\xdfe \xe4"]
+
+
+@pytest.mark.parametrize('content_type,charset', [
+    ("text/html", "utf-8"),
+    ("text/html; charset=utf-8", "utf-8"),
+    ("text/html; charset=ISO-8859-1", "iso-8859-1"),
+])
+def test_get_leo_page_header_charset(session, content_type, charset):
+    adapter = MockAdapter(body=UMLAUT_PAGE.encode(charset),
+                          content_type=content_type)
+    session.mount("http://", adapter)
+    page, encoding = leo.get_leo_page("http://mock/englisch-deutsch/foo")
+    texts = [leo.extract_text(section)
+             for section in leo.iter_sections(page, ["subst"],
+                                              encoding=encoding)]
+    assert texts == ["Stra\xdfe \xe4"]
+
+
+def test_iter_sections_center_column_only():
+    page = BytesIO(b"""<html><body>
+    <div class="section" data-dz-name="subst">outside</div>
+    <div id="centerColumn">
+      <div class="result section" data-dz-name="subst">inside</div>
+      <div class="sections" data-dz-name="verb">no section</div>
+    </div></body></html>""")
+    sections = leo.iter_sections(page, ["subst", "verb"])
+    assert [section.text for section in sections] == ["inside"]
+
+
 def test_extract_text():
     expected = ["subst_en_foo", "subst_de_foo"]
     tr = html.fromstring(
@@ -72,6 +222,15 @@ def test_extract_text():
     assert tds_text == expected
 
 
+@pytest.mark.parametrize('markup,expected', [
+    ("<td> <a> foo </a> </td>", "foo"),
+    ("<td><a>foo\xa0</a> <b>\n  bar   baz\n</b></td>", "foo bar baz"),
+    ("<td><a>Stra\xdfe</a></td>", "Straße"),
+])
+def test_extract_text_whitespace(markup, expected):
+    assert leo.extract_text(html.fromstring(markup)) == expected
+
+
 def test_format_as_table(capsys):
 
     expected = ["foo", "bar", "foobar", "foobaz"]
@@ -112,3 +271,51 @@ def test_format_as_table(capsys):
     for e in expected:
 
         assert e in captured.out
+
+
+def test_format_as_table_empty(capsys):
+    leo.format_as_table([])
+    captured = capsys.readouterr()
+    assert captured.out == ""
+
+
+def test_format_as_table_header(capsys):
+    tr = html.fromstring(
+        """<table><tr><td></td><td></td><td></td><td></td>
+        <td lang="en">foo</td><td></td><td></td><td lang="de">bar</td>
+        </tr></table>"""
+    )
+    leo.format_as_table(tr.findall("tr"), "-- Header --\n")
+    captured = capsys.readouterr()
+    assert captured.out == "-- Header --\nfoo | bar\n"
+
+
+def test_get_results_closes_source():
+    args = leo.parse(["-l", "en", "foo"])
+    with open(path.join(path.dirname(__file__),
+                        "data/leo_mock_response.html"), "rb") as htmlfile:
+        source = BytesIO(htmlfile.read())
+    leo.get_results(args, source)
+    assert source.closed
+
+
+def test_main_queries_in_order(session, capsys):
+    session.mount("http://", MockAdapter())
+    assert leo.main(["Baum", "Haus"]) == 0
+    out = capsys.readouterr().out
+    baum = out.index("========== Baum ==========")
+    haus = out.index("========== Haus ==========")
+    assert baum < out.index("subst_en_foo", baum) < haus
+    assert out.count("subst_en_foo") == 2
+
+
+def test_main_failing_query(session, capsys, caplog):
+    adapter = MockAdapter(not_found=("Baum",))
+    session.mount("http://", adapter)
+    assert leo.main(["Baum", "Haus"]) == 20
+    captured = capsys.readouterr()
+    assert adapter.calls == 2
+    assert "No translation for Baum was found" in caplog.text
+    haus = captured.out.index("========== Haus ==========")
+    assert "subst_en_foo" in captured.out[haus:]
+    assert "subst_en_foo" not in captured.out[:haus]